@@ -7,7 +7,8 @@ Goals:
 - Keep your existing JSON schema (and future fields like aliases/inputMode/lists/schemaVersion) intact.
 - Update only numeric fields (price/usdPrice/change24h) + fetchedAtMs/source.
 - Be fast & cheap in CI:
-  * Prefer plain HTTP fetch + BeautifulSoup parse
+  * Prefer plain HTTP fetch + bonbast's own /json endpoint
+  * Then selectolax (lexbor, C-backed) parse of the same HTML
   * Fallback to Selenium only if needed (optional)
 
 Output: rates_v2_latest (minified JSON, UTF-8, stable key order from template)
@@ -16,22 +17,33 @@ Output: rates_v2_latest (minified JSON, UTF-8, stable key order from template)
 from __future__ import annotations
 
 import csv
-import json
 import hashlib
+import io
+import logging
 import os
 import re
+import sys
 import time
-import urllib.request
-from dataclasses import dataclass
-from typing import Any, Dict, Iterable, Optional, Tuple
-
-from bs4 import BeautifulSoup
-
-# Optional Selenium fallback (only used if HTTP fetch doesn't return enough data)
-USE_SELENIUM_FALLBACK = True
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Container, Dict, Iterable, Iterator, Optional, Tuple, Union
+
+import orjson
+import urllib3
+from selectolax.lexbor import LexborHTMLParser
+
+# Optional Selenium fallback (only used if HTTP fetch doesn't return enough data).
+# Set BONBAST_SELENIUM_FALLBACK=0 to never start a browser (HTTP + /json only).
+USE_SELENIUM_FALLBACK = os.environ.get("BONBAST_SELENIUM_FALLBACK", "1") != "0"
 SELENIUM_WAIT_SECONDS = 12  # lower == cheaper CI
+# Reuse a long-lived chromedriver / Selenium server instead of spawning one per run,
+# e.g. start `chromedriver --port=9515` once and set SELENIUM_REMOTE_URL=http://localhost:9515
+SELENIUM_REMOTE_URL = os.environ.get("SELENIUM_REMOTE_URL", "")
 
 BONBAST_URL = "https://bonbast.com/"
+BONBAST_JSON_URL = "https://bonbast.com/json"  # what the page itself POSTs to for prices
 CRYPTO_CSV_URL = (
     "https://raw.githubusercontent.com/michaelvincentsebastian/"
     "Automated-Crypto-Market-Insights/refs/heads/main/latest-data/latest_data.csv"
@@ -44,6 +56,9 @@ TEMPLATE_FILE = "rates_v2_latest"  # read current committed file and update it
 
 # KV-side keys are unrelated here; this is the generator that creates the GitHub file.
 
+# One logger, configured once in main(); status lines are emitted per phase, never per row.
+log = logging.getLogger("rates")
+
 
 # ---------------------------
 # Helpers: digits & numbers
@@ -56,7 +71,7 @@ _PERSIAN_ARABIC_DIGITS = str.maketrans({
     "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
 })
 
-_num_re = re.compile(r"[0-9]+")
+_non_digit_re = re.compile(r"[^0-9]+")
 
 
 def to_int_price(text: str) -> Optional[int]:
@@ -66,25 +81,23 @@ def to_int_price(text: str) -> Optional[int]:
     """
     if not text:
         return None
-    t = text.translate(_PERSIAN_ARABIC_DIGITS)
-    m = _num_re.findall(t)
-    if not m:
-        return None
-    # join all digit groups (handles commas/spaces)
-    try:
-        return int("".join(m))
-    except Exception:
-        return None
+    # ASCII text (the common case) has no Persian/Arabic digits to translate
+    t = text if text.isascii() else text.translate(_PERSIAN_ARABIC_DIGITS)
+    # drop everything but ASCII digits in one pass (handles commas/spaces)
+    digits = _non_digit_re.sub("", t)
+    return int(digits) if digits else None
+
 
+# ZWNJ -> space, unify half/quarter glyphs
+_NORM_TRANS = str.maketrans({"\u200c": " ", "½": "half ", "¼": "quarter "})
+# any run of non-alnum (whitespace included) collapses to one space
+_NORM_RE = re.compile(r"[^a-z0-9]+")
 
+
+@lru_cache(maxsize=4096)
 def norm_key(s: str) -> str:
     """Normalize names for matching (titles, csv names, etc.)."""
-    s = (s or "").strip().lower()
-    s = s.replace("\u200c", " ")  # ZWNJ
-    # unify half/quarter glyphs and spaces
-    s = s.replace("½", "half ").replace("¼", "quarter ")
-    s = re.sub(r"[^a-z0-9]+", " ", s)
-    return re.sub(r"\s+", " ", s).strip()
+    return _NORM_RE.sub(" ", (s or "").lower().translate(_NORM_TRANS)).strip()
 
 
 # ---------------------------
@@ -96,6 +109,10 @@ class Payload:
     fetchedAtMs: int
     source: str
     rates: Dict[str, Dict[str, Any]]
+    # normalized name -> key, one resolver per source ("bonbast", "crypto")
+    name_idx: Dict[str, Dict[str, str]] = field(default_factory=dict)
+    # the whole parsed template (extra top-level keys are carried over on write)
+    original: Dict[str, Any] = field(default_factory=dict)
 
 
 def load_template(path: str) -> Payload:
@@ -104,8 +121,8 @@ def load_template(path: str) -> Payload:
       - emoji/fa/title/kind/unit
       - future fields (aliases/inputMode/lists/schemaVersion/...)
     """
-    with open(path, "r", encoding="utf-8") as f:
-        obj = json.load(f)
+    with open(path, "rb") as f:
+        obj = orjson.loads(f.read())
 
     if not isinstance(obj, dict) or "rates" not in obj or not isinstance(obj["rates"], dict):
         raise RuntimeError(f"Template JSON is invalid: {path}")
@@ -114,93 +131,295 @@ def load_template(path: str) -> Payload:
     source = str(obj.get("source") or "")
     rates = obj["rates"]
 
-    return Payload(fetchedAtMs=fetched, source=source, rates=rates)
+    return Payload(
+        fetchedAtMs=fetched,
+        source=source,
+        rates=rates,
+        name_idx=build_name_indexes(rates),
+        original=obj,
+    )
 
 
 # ---------------------------
 # Bonbast fetch + parse
 # ---------------------------
 
-def http_get(url: str, timeout: int = 20) -> str:
-    req = urllib.request.Request(
+# One keep-alive pool shared by the bonbast + crypto fetches (and their retries)
+_POOL = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=4,
+    retries=urllib3.Retry(3, backoff_factor=0.2),
+    timeout=urllib3.Timeout(connect=5, read=20),
+)
+
+_DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36",
+    "Accept-Language": "en-US,en;q=0.9,fa;q=0.8",
+    # gzip/deflate (+ br/zstd when their decoders are installed); urllib3 decompresses
+    "Accept-Encoding": urllib3.util.make_headers(accept_encoding=True)["accept-encoding"],
+}
+
+
+def http_get(
+    url: str,
+    timeout: int = 20,
+    headers: Optional[Dict[str, str]] = None,
+    decode: bool = True,
+) -> Union[str, bytes]:
+    """GET via the shared pool; decode=False returns raw bytes (the HTML parser takes them as-is)."""
+    resp = _POOL.request(
+        "GET",
         url,
-        headers={
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
-                          "(KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36",
-            "Accept-Language": "en-US,en;q=0.9,fa;q=0.8",
-        },
+        headers={**_DEFAULT_HEADERS, **(headers or {})},
+        timeout=urllib3.Timeout(connect=5, read=timeout),
+    )
+    if resp.status >= 400:
+        raise RuntimeError(f"HTTP {resp.status} for {url}")
+    if not decode:
+        return resp.data
+    return resp.data.decode("utf-8", errors="replace")
+
+
+@contextmanager
+def http_stream(
+    url: str,
+    timeout: int = 20,
+    headers: Optional[Dict[str, str]] = None,
+) -> Iterator[urllib3.HTTPResponse]:
+    """
+    Like http_get, but yields the unread response (status/headers + a file-like
+    body, e.g. for io.TextIOWrapper) instead of buffering it.
+    """
+    resp = _POOL.request(
+        "GET",
+        url,
+        headers={**_DEFAULT_HEADERS, **(headers or {})},
+        timeout=urllib3.Timeout(connect=5, read=timeout),
+        preload_content=False,
     )
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        return resp.read().decode("utf-8", errors="replace")
+    try:
+        if resp.status >= 400:
+            raise RuntimeError(f"HTTP {resp.status} for {url}")
+        resp.auto_close = False  # TextIOWrapper needs the response to stay readable
+        yield resp
+    finally:
+        # early returns / errors leave body bytes on the socket; read them off
+        # first so the pool never hands out a connection mid-response
+        resp.drain_conn()
+        resp.release_conn()
+
+
+# Top items by element id -> display name
+_BONBAST_TOP_IDS = {
+    "gol18": "Gold Gram 18k",
+    "mithqal": "Gold Mithqal",
+    "ounce": "Gold Ounce",
+    # "ju18": "Gold Gram 18k Jewelry",  # not in template by default; handled via title matching if you add it
+}
+# all top ids in one selector -> one tree traversal instead of one per id
+_BONBAST_TOP_SELECTOR = ", ".join(f"#{elem_id}" for elem_id in _BONBAST_TOP_IDS)
 
 
-def parse_bonbast_html(html: str) -> Dict[str, int]:
+# Free-threaded builds (3.13t with the GIL off) can run CPU-bound parsing on real threads
+_FREE_THREADED = not getattr(sys, "_is_gil_enabled", lambda: True)()
+
+
+def _parse_table_rows(table: Any) -> list[Tuple[str, int]]:
+    """(display_name, price) for each price row of one bonbast <table>, in order."""
+    rows: list[Tuple[str, int]] = []
+    for row in table.css("tr"):
+        # direct <td> children only: no per-row selector match over the subtree
+        cols = [c for c in row.iter() if c.tag == "td"]
+        name = ""
+        price = ""
+
+        if len(cols) == 4:
+            name = cols[1].text(strip=True)
+            price = cols[2].text(strip=True)
+        elif len(cols) == 3:
+            name = cols[0].text(strip=True)
+            price = cols[1].text(strip=True)
+
+        # cheap check first: most non-price rows have no name cell at all
+        if not name:
+            continue
+        p = to_int_price(price)
+        if p is None:
+            continue
+
+        # Normalize coin naming (copied from your current logic)
+        if "Emami" in name:
+            name = "Emami"
+        elif "Azadi" in name and "Gera" not in name and "½" not in name and "¼" not in name:
+            name = "Azadi"
+        elif "Half" in name:
+            name = "½ Azadi"
+        elif "Quarter" in name:
+            name = "¼ Azadi"
+        elif "Gram" in name and "Coin" in name:
+            name = "Gerami"
+
+        rows.append((name, p))
+    return rows
+
+
+def _parse_table_html(html: str) -> list[Tuple[str, int]]:
+    """_parse_table_rows on a private tree: selectolax nodes/selectors of one tree are not thread-safe."""
+    return _parse_table_rows(LexborHTMLParser(html).css_first("table"))
+
+
+def parse_bonbast_html(html: Union[str, bytes], wanted: Optional[Iterable[str]] = None) -> Dict[str, int]:
     """
     Returns mapping: bonbast_display_name -> integer_price
     (we'll map names to template keys later)
+
+    If `wanted` is given, stop walking tables as soon as every wanted name
+    (compared via norm_key) has been seen.
     """
-    soup = BeautifulSoup(html, "html.parser")
+    tree = LexborHTMLParser(html)
 
     out: Dict[str, int] = {}
 
     # Top items by id (same as your current script)
-    top_items = {
-        "gol18": "Gold Gram 18k",
-        "mithqal": "Gold Mithqal",
-        "ounce": "Gold Ounce",
-        # "ju18": "Gold Gram 18k Jewelry",  # not in template by default; handled via title matching if you add it
-    }
-    for elem_id, display_name in top_items.items():
-        el = soup.find(id=elem_id)
-        if not el:
-            continue
-        p = to_int_price(el.get_text(strip=True))
+    seen_ids = set()
+    for el in tree.css(_BONBAST_TOP_SELECTOR):
+        elem_id = el.id
+        if elem_id in seen_ids:
+            continue  # like css_first: only the first element per id counts
+        seen_ids.add(elem_id)
+        p = to_int_price(el.text(strip=True))
         if p is not None:
-            out[display_name] = p
+            out[_BONBAST_TOP_IDS[elem_id]] = p
 
-    # Tables (same heuristic as your current script)
-    for table in soup.find_all("table"):
-        for row in table.find_all("tr"):
-            cols = row.find_all("td")
-            name = ""
-            price = ""
-
-            if len(cols) == 4:
-                name = cols[1].get_text(strip=True)
-                price = cols[2].get_text(strip=True)
-            elif len(cols) == 3:
-                name = cols[0].get_text(strip=True)
-                price = cols[1].get_text(strip=True)
-
-            p = to_int_price(price)
-            if not name or p is None:
-                continue
+    remaining = None
+    if wanted is not None:
+        remaining = {norm_key(w) for w in wanted} - {norm_key(n) for n in out}
 
-            # Normalize coin naming (copied from your current logic)
-            if "Emami" in name:
-                name = "Emami"
-            elif "Azadi" in name and "Gera" not in name and "½" not in name and "¼" not in name:
-                name = "Azadi"
-            elif "Half" in name:
-                name = "½ Azadi"
-            elif "Quarter" in name:
-                name = "¼ Azadi"
-            elif "Gram" in name and "Coin" in name:
-                name = "Gerami"
+    # Tables (same heuristic as your current script)
+    tables = tree.css("table")
+    if _FREE_THREADED and len(tables) > 1:
+        # no GIL: parse tables in parallel, then merge in page order. Workers never
+        # touch `tree` (its cached CSS selector and text buffers are shared mutable
+        # state); each gets the table's serialized HTML and builds its own parser.
+        table_htmls = [t.html for t in tables]
+        with ThreadPoolExecutor(max_workers=min(len(tables), os.cpu_count() or 1)) as ex:
+            per_table: Iterable[list[Tuple[str, int]]] = list(ex.map(_parse_table_html, table_htmls))
+    else:
+        # lazy: with `wanted`, tables after the break are never parsed
+        per_table = map(_parse_table_rows, tables)
 
+    for rows in per_table:
+        for name, p in rows:
             out[name] = p
+            if remaining:
+                remaining.discard(norm_key(name))
+
+        # everything the template needs is in hand; later tables are not touched
+        if remaining is not None and not remaining:
+            break
+
+    return out
+
+
+# heuristic: if very few items, page probably needs JS or blocked
+_MIN_BONBAST_ITEMS = 15
+
+_BONBAST_TOKEN_RE = re.compile(rb'param\s*:\s*"([^"]+)"')
+
+# /json keys -> the display names parse_bonbast_html produces ("...1" = sell, "...2" = buy)
+_BONBAST_JSON_NAMES = {
+    "gol18": "Gold Gram 18k",
+    "mithqal": "Gold Mithqal",
+    "ounce": "Gold Ounce",
+    "emami1": "Emami",
+    "azadi1": "Azadi",
+    "azadi1_2": "½ Azadi",
+    "azadi1_4": "¼ Azadi",
+    "azadi1g": "Gerami",
+}
+# currency sell prices: usd1 -> "USD" (matched to template keys by code)
+_BONBAST_JSON_CURRENCY_RE = re.compile(r"([a-z]{3})1")
+
+
+def fetch_bonbast_json(html: bytes) -> Dict[str, int]:
+    """
+    Structured path: POST the token embedded in the bonbast page to /json,
+    exactly like the site's own script does. No DOM walk needed.
+    """
+    m = _BONBAST_TOKEN_RE.search(html)
+    if not m:
+        raise RuntimeError("token not found in page")
+
+    resp = _POOL.request(
+        "POST",
+        BONBAST_JSON_URL,
+        fields={"param": m.group(1).decode("utf-8", errors="replace")},
+        encode_multipart=False,
+        headers={
+            **_DEFAULT_HEADERS,
+            "Accept": "application/json, text/javascript, */*; q=0.01",
+            "X-Requested-With": "XMLHttpRequest",
+            "Origin": BONBAST_URL.rstrip("/"),
+            "Referer": BONBAST_URL,
+            "Cookie": "st_bb=0",
+        },
+    )
+    if resp.status >= 400:
+        raise RuntimeError(f"HTTP {resp.status} for {BONBAST_JSON_URL}")
 
+    obj = orjson.loads(resp.data)
+    if not isinstance(obj, dict) or "reset" in obj:
+        raise RuntimeError("token rejected")
+
+    out: Dict[str, int] = {}
+    for k, v in obj.items():
+        name = _BONBAST_JSON_NAMES.get(k)
+        if name is None:
+            cm = _BONBAST_JSON_CURRENCY_RE.fullmatch(k)
+            if not cm:
+                continue
+            name = cm.group(1).upper()
+        p = to_int_price(str(v))
+        if p is not None:
+            out[name] = p
     return out
 
 
-def scrape_bonbast_fast() -> Dict[str, int]:
-    """Fast path: plain HTTP fetch."""
-    html = http_get(BONBAST_URL, timeout=20)
-    parsed = parse_bonbast_html(html)
+def scrape_bonbast_fast(wanted: Optional[Iterable[str]] = None) -> Dict[str, int]:
+    """Fast path: one plain HTTP fetch, then /json (or parse that same HTML if /json fails)."""
+    html = http_get(BONBAST_URL, timeout=20, decode=False)
+    try:
+        data = fetch_bonbast_json(html)
+        if len(data) >= _MIN_BONBAST_ITEMS:
+            return data
+        log.info("[bonbast] /json returned only %d items -> parsing HTML...", len(data))
+    except Exception as e:
+        log.warning("[bonbast] /json failed: %s -> parsing HTML...", e)
+
+    parsed = parse_bonbast_html(html, wanted)
     return parsed
 
 
-def scrape_bonbast_selenium() -> Dict[str, int]:
+def _local_chromedriver() -> Optional[str]:
+    """
+    A chromedriver already on disk, so Selenium Manager's lookup can be skipped:
+    CHROMEDRIVER_PATH, or the one GitHub-hosted runners ship ($CHROMEWEBDRIVER dir).
+    """
+    candidates = [os.environ.get("CHROMEDRIVER_PATH", "")]
+    if os.environ.get("CHROMEWEBDRIVER"):
+        candidates.append(os.path.join(os.environ["CHROMEWEBDRIVER"], "chromedriver"))
+    for path in candidates:
+        if path and os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+# stylesheet/font URL patterns the Selenium fallback never needs (we only read DOM text)
+_BLOCKED_ASSET_URLS = ["*.css*", "*.woff*", "*.ttf*", "*.otf*", "*.eot*"]
+
+
+def scrape_bonbast_selenium(wanted: Optional[Iterable[str]] = None) -> Dict[str, int]:
     """Slow fallback: Selenium (kept optional)."""
     try:
         from selenium import webdriver
@@ -209,7 +428,6 @@ def scrape_bonbast_selenium() -> Dict[str, int]:
         from selenium.webdriver.support.ui import WebDriverWait
         from selenium.webdriver.support import expected_conditions as EC
         from selenium.webdriver.common.by import By
-        from webdriver_manager.chrome import ChromeDriverManager
     except Exception as e:
         raise RuntimeError(f"Selenium fallback requested but deps missing: {e}")
 
@@ -221,45 +439,66 @@ def scrape_bonbast_selenium() -> Dict[str, int]:
     chrome_options.add_argument("--disable-gpu")
     chrome_options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
                                 "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/143.0.0.0 Safari/537.36")
+    # we only need DOM text: skip images (CSS/fonts are blocked over CDP below)
+    # and background traffic
+    chrome_options.add_experimental_option("prefs", {
+        "profile.managed_default_content_settings.images": 2,
+    })
+    chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+    chrome_options.add_argument("--disable-extensions")
+    chrome_options.add_argument("--disable-background-networking")
+    # driver.get returns at DOMContentLoaded; WebDriverWait below covers the rest
+    chrome_options.page_load_strategy = "eager"
 
     driver = None
     try:
-        service = Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=chrome_options)
+        if SELENIUM_REMOTE_URL:
+            # quit() below only ends our session; the driver process stays up
+            driver = webdriver.Remote(command_executor=SELENIUM_REMOTE_URL, options=chrome_options)
+        else:
+            # Prefer a driver already on disk; otherwise Selenium >= 4.11 resolves it
+            # itself (Selenium Manager, cached in ~/.cache/selenium)
+            service = Service(_local_chromedriver())
+            driver = webdriver.Chrome(service=service, options=chrome_options)
+            # Chrome has no content setting for CSS/fonts; block them at the network layer
+            # (CDP is only exposed on a local ChromeDriver session, not webdriver.Remote)
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": _BLOCKED_ASSET_URLS})
         driver.get(BONBAST_URL)
 
-        # cheaper than sleep(15): wait for at least one table to exist
+        # cheaper than sleep(15): return as soon as price cells are rendered
+        # (an empty <table> shell can exist before the rows are filled in)
         WebDriverWait(driver, SELENIUM_WAIT_SECONDS).until(
-            EC.presence_of_element_located((By.TAG_NAME, "table"))
+            EC.presence_of_element_located((By.CSS_SELECTOR, "table tr td"))
         )
 
-        html = driver.page_source
-        parsed = parse_bonbast_html(html)
+        # live DOM in one script round-trip, serialized in-browser
+        html = driver.execute_script("return document.documentElement.outerHTML")
+        parsed = parse_bonbast_html(html, wanted)
         return parsed
     finally:
         if driver:
             driver.quit()
 
 
-def scrape_bonbast() -> Dict[str, int]:
+def scrape_bonbast(wanted: Optional[Iterable[str]] = None) -> Dict[str, int]:
     # Try HTTP first (fast/cheap)
     try:
-        data = scrape_bonbast_fast()
-        # heuristic: if very few items, page probably needs JS or blocked
-        if len(data) >= 15:
+        data = scrape_bonbast_fast(wanted)
+        if len(data) >= _MIN_BONBAST_ITEMS:
             return data
-        print(f"[bonbast] HTTP parse returned only {len(data)} items -> trying Selenium fallback...")
+        log.info("[bonbast] HTTP parse returned only %d items -> trying Selenium fallback...", len(data))
     except Exception as e:
-        print(f"[bonbast] HTTP fetch failed: {e} -> trying Selenium fallback...")
+        log.warning("[bonbast] HTTP fetch failed: %s -> trying Selenium fallback...", e)
 
     if not USE_SELENIUM_FALLBACK:
         return {}
 
     try:
-        data = scrape_bonbast_selenium()
+        data = scrape_bonbast_selenium(wanted)
         return data
     except Exception as e:
-        print(f"[bonbast] Selenium failed: {e}")
+        log.warning("[bonbast] Selenium failed: %s", e)
         return {}
 
 
@@ -267,39 +506,58 @@ def scrape_bonbast() -> Dict[str, int]:
 # Crypto CSV fetch
 # ---------------------------
 
-def fetch_crypto_csv(url: str) -> Dict[str, Tuple[float, float]]:
+def fetch_crypto_csv(
+    url: str,
+    etag: str = "",
+    known: Optional[Container[str]] = None,
+) -> Tuple[Dict[str, Tuple[float, float]], str, bool]:
     """
-    Returns: name -> (usd_price, change24h_fraction)
+    Returns: (name -> (usd_price, change24h_fraction), etag, not_modified)
     where change24h_fraction is like 0.054 (== 5.4%)
-    """
-    req = urllib.request.Request(
-        url,
-        headers={"User-Agent": "Mozilla/5.0", "Accept": "text/csv,*/*;q=0.8"},
-    )
-    with urllib.request.urlopen(req, timeout=25) as resp:
-        text = resp.read().decode("utf-8", errors="replace")
-
-    reader = csv.DictReader(text.splitlines())
-    if not reader.fieldnames:
-        return {}
 
-    required = {"name", "price", "percent_change_24h"}
-    if not required.issubset(set(reader.fieldnames)):
-        print(f"[crypto] CSV missing required columns. Found: {reader.fieldnames}")
-        return {}
+    If `known` (normalized names, e.g. the crypto name index) is given, rows
+    whose norm_key(name) is not in it are skipped before any float parsing.
 
-    out: Dict[str, Tuple[float, float]] = {}
-    for row in reader:
-        name = (row.get("name") or "").strip()
-        if not name:
-            continue
+    Conditional GET: if `etag` (from the previous run) still matches, the server
+    answers 304 with no body and we return ({}, etag, True) -- nothing to update.
+    """
+    headers = {"User-Agent": "Mozilla/5.0", "Accept": "text/csv,*/*;q=0.8"}
+    if etag:
+        headers["If-None-Match"] = etag
+
+    with http_stream(url, timeout=25, headers=headers) as resp:
+        if resp.status == 304:
+            log.info("[crypto] CSV not modified since last run (ETag)")
+            return {}, etag, True
+        new_etag = resp.headers.get("ETag", "")
+
+        f = io.TextIOWrapper(resp, encoding="utf-8", errors="replace", newline="")
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header:
+            return {}, new_etag, False
+
+        # resolve column positions once instead of a dict per row
         try:
-            usd_price = float(row.get("price") or 0.0)
-            pct = float(row.get("percent_change_24h") or 0.0)
-        except Exception:
-            continue
-        out[name] = (usd_price, pct / 100.0)
-    return out
+            ni = header.index("name")
+            pi = header.index("price")
+            ci = header.index("percent_change_24h")
+        except ValueError:
+            log.warning("[crypto] CSV missing required columns. Found: %s", header)
+            return {}, new_etag, False
+
+        out: Dict[str, Tuple[float, float]] = {}
+        for row in reader:
+            try:
+                name = row[ni].strip()
+                if not name or (known is not None and norm_key(name) not in known):
+                    continue
+                usd_price = float(row[pi] or 0.0)
+                pct = float(row[ci] or 0.0)
+            except (IndexError, ValueError):
+                continue
+            out[name] = (usd_price, pct / 100.0)
+        return out, new_etag, False
 
 
 # ---------------------------
@@ -320,36 +578,67 @@ TOP_NAME_TO_KEY = {
     "Gold Ounce": "gold_ounce",
 }
 
+# both tables merged once (seed of the bonbast name resolver)
+_BONBAST_NAME_TO_KEY = {**COIN_NAME_TO_KEY, **TOP_NAME_TO_KEY}
+
 
-def build_title_index(rates: Dict[str, Dict[str, Any]], kind: str) -> Dict[str, str]:
-    """title normalized -> key"""
-    idx: Dict[str, str] = {}
+def build_name_indexes(rates: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, str]]:
+    """
+    One resolver per source, normalized name -> key, built once in load_template:
+      - "bonbast": fixed coin/top names, then currency title/fa, then code/aliases
+      - "crypto":  crypto title/fa, then code/aliases
+    First entry wins, so an alias never shadows another rate's title.
+    """
+    bonbast = {norm_key(n): k for n, k in _BONBAST_NAME_TO_KEY.items() if k in rates}
+    crypto: Dict[str, str] = {}
+    by_kind = {"currency": bonbast, "crypto": crypto}
+
+    # titles/fa first...
     for key, r in rates.items():
-        if str(r.get("kind")) != kind:
+        idx = by_kind.get(r.get("kind"))
+        if idx is None:
             continue
-        title = str(r.get("title") or "")
-        if title:
-            idx[norm_key(title)] = key
-    return idx
+        for raw in (r.get("title"), r.get("fa")):
+            nk = norm_key(str(raw or ""))
+            if nk:
+                idx.setdefault(nk, key)
+
+    # ...then codes (bonbast /json reports currencies as USD, EUR, ...) and aliases
+    for key, r in rates.items():
+        idx = by_kind.get(r.get("kind"))
+        if idx is None:
+            continue
+        aliases = r.get("aliases")
+        for raw in [key, *(aliases if isinstance(aliases, list) else ())]:
+            nk = norm_key(raw) if isinstance(raw, str) else ""
+            if nk:
+                idx.setdefault(nk, key)
+
+    return {"bonbast": bonbast, "crypto": crypto}
+
+
+def bonbast_wanted_names(payload: Payload) -> list[str]:
+    """Display names update_from_bonbast can place: fixed coin/top names + currency titles."""
+    names = [n for n, k in _BONBAST_NAME_TO_KEY.items() if k in payload.rates]
+    names.extend(
+        str(r.get("title"))
+        for r in payload.rates.values()
+        if r.get("kind") == "currency" and r.get("title")
+    )
+    return names
 
 
 def update_from_bonbast(payload: Payload, bonbast: Dict[str, int]) -> None:
     rates = payload.rates
 
-    currency_title_idx = build_title_index(rates, "currency")
-    # also allow matching by existing fa (in case bonbast changes to Persian later)
-    currency_fa_idx = {norm_key(str(v.get("fa") or "")): k for k, v in rates.items() if v.get("kind") == "currency" and v.get("fa")}
+    # coin/top names + currency title/fa/code/aliases (fa in case bonbast goes Persian later)
+    name_idx = payload.name_idx.get("bonbast", {})
 
     updated = 0
     skipped = 0
 
     for name, price in bonbast.items():
-        key = COIN_NAME_TO_KEY.get(name) or TOP_NAME_TO_KEY.get(name)
-
-        if not key:
-            nk = norm_key(name)
-            key = currency_title_idx.get(nk) or currency_fa_idx.get(nk)
-
+        key = name_idx.get(norm_key(name))
         if not key or key not in rates:
             skipped += 1
             continue
@@ -357,7 +646,7 @@ def update_from_bonbast(payload: Payload, bonbast: Dict[str, int]) -> None:
         rates[key]["price"] = price
         updated += 1
 
-    print(f"[bonbast] updated={updated} skipped={skipped}")
+    log.info("[bonbast] updated=%d skipped=%d", updated, skipped)
 
 
 def recompute_usd_relations(payload: Payload) -> None:
@@ -368,26 +657,25 @@ def recompute_usd_relations(payload: Payload) -> None:
         usd_price = float(usd["price"])
 
     if not usd_price:
-        print("[usdPrice] usd price missing; skipping usdPrice recompute")
+        log.warning("[usdPrice] usd price missing; skipping usdPrice recompute")
         return
 
+    # single pass, one kind lookup per rate; gold (and anything else) falls through
     for key, r in rates.items():
-        kind = str(r.get("kind") or "")
-        if kind not in ("currency", "crypto"):
-            continue
+        kind = r.get("kind")
 
         # keep existing fields and only update if present or if it makes sense
         if kind == "currency":
             if key == "usd":
                 r["usdPrice"] = 1
-            else:
-                if "usdPrice" in r:
-                    r["usdPrice"] = float(r.get("price", 0.0)) / usd_price
+            elif "usdPrice" in r:
+                r["usdPrice"] = float(r.get("price", 0.0)) / usd_price
 
         elif kind == "crypto":
             # for crypto we always want local price = usdPrice * usd_local
-            if "usdPrice" in r and isinstance(r["usdPrice"], (int, float)):
-                r["price"] = float(r["usdPrice"]) * usd_price
+            up = r.get("usdPrice")
+            if isinstance(up, (int, float)):
+                r["price"] = float(up) * usd_price
 
     # Special case: gold_ounce has usdPrice and is used like crypto (in your current JSON sample)
     go = rates.get("gold_ounce")
@@ -400,16 +688,16 @@ def update_from_crypto_csv(payload: Payload, crypto: Dict[str, Tuple[float, floa
     usd = rates.get("usd")
     usd_local = float(usd.get("price")) if usd and usd.get("price") else None
     if not usd_local:
-        print("[crypto] usd local price missing; cannot compute local crypto price")
+        log.warning("[crypto] usd local price missing; cannot compute local crypto price")
         usd_local = 1.0
 
-    crypto_title_idx = build_title_index(rates, "crypto")
+    name_idx = payload.name_idx.get("crypto", {})
 
     updated = 0
     skipped = 0
 
     for name, (usd_price, change24h) in crypto.items():
-        key = crypto_title_idx.get(norm_key(name))
+        key = name_idx.get(norm_key(name))
         if not key:
             skipped += 1
             continue
@@ -419,12 +707,13 @@ def update_from_crypto_csv(payload: Payload, crypto: Dict[str, Tuple[float, floa
             skipped += 1
             continue
 
-        r["usdPrice"] = float(usd_price)
-        r["change24h"] = float(change24h)
-        r["price"] = float(usd_price) * float(usd_local)
+        # fetch_crypto_csv already yields floats; usd_local is a float too
+        r["usdPrice"] = usd_price
+        r["change24h"] = change24h
+        r["price"] = usd_price * usd_local
         updated += 1
 
-    print(f"[crypto] updated={updated} skipped={skipped}")
+    log.info("[crypto] updated=%d skipped=%d", updated, skipped)
 
 
 # ---------------------------
@@ -497,8 +786,7 @@ def compute_alias_index(rates: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
         key = normalize_alias(raw)
         if not key or key in _GENERIC_ALIAS:
             return
-        if key not in out:
-            out[key] = code
+        out.setdefault(key, code)  # first-seen wins, one hash lookup
 
     for code, r in rates.items():
         add(code, code)
@@ -567,8 +855,7 @@ def numeric_fingerprint(rates: Dict[str, Dict[str, Any]]) -> str:
     for code in sorted(rates.keys()):
         r = rates[code]
         rows.append((code, r.get("price"), r.get("usdPrice"), r.get("change24h")))
-    blob = json.dumps(rows, ensure_ascii=False, separators=(",", ":"))
-    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+    return hashlib.sha1(orjson.dumps(rows)).hexdigest()
 
 
 
@@ -596,42 +883,76 @@ def validate_payload(payload: Payload) -> Tuple[bool, str]:
     return True, "ok"
 
 
+def write_atomic(path: str, data: bytes) -> None:
+    """Write to path + ".tmp", fsync, then rename over path (never leaves a half-written file)."""
+    tmp = path + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+
 # ---------------------------
 # Main
 # ---------------------------
 
 def main() -> int:
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+
     if not os.path.exists(TEMPLATE_FILE):
-        print(f"Template file not found: {TEMPLATE_FILE}")
-        print("Tip: commit a baseline rates_v2_latest first (with metadata/aliases/etc).")
+        log.error("Template file not found: %s", TEMPLATE_FILE)
+        log.error("Tip: commit a baseline rates_v2_latest first (with metadata/aliases/etc).")
         return 2
 
-    # Load original template to preserve any custom top-level keys
-    with open(TEMPLATE_FILE, "r", encoding="utf-8") as f:
-        original = json.load(f) if os.path.getsize(TEMPLATE_FILE) > 0 else {}
-
     payload = load_template(TEMPLATE_FILE)
+    # Original template (parsed once) to preserve any custom top-level keys
+    original = payload.original
 
     before_fp = numeric_fingerprint(payload.rates)
-    before_idx_blob = json.dumps([original.get("lists"), original.get("aliasIndex")], ensure_ascii=False, separators=(",", ":"))
-    before_fp = before_fp + "|" + hashlib.sha1(before_idx_blob.encode("utf-8")).hexdigest()
+    before_idx_blob = orjson.dumps([original.get("lists"), original.get("aliasIndex")])
+    before_fp = before_fp + "|" + hashlib.sha1(before_idx_blob).hexdigest()
+
+    # ETag of the CSV our committed crypto prices came from (conditional GET). It only
+    # vouches for upstream: if the template's crypto names changed since (rate added,
+    # alias edited), the committed prices don't cover them, so fetch in full.
+    crypto_idx = payload.name_idx.get("crypto", {})
+    crypto_idx_hash = hashlib.sha1(orjson.dumps(sorted(crypto_idx.items()))).hexdigest()
+    prev_crypto_etag = ""
+    if original.get("cryptoIndexHash") == crypto_idx_hash:
+        prev_crypto_etag = str(original.get("cryptoEtag") or "")
+
+    # Both sources are independent network I/O: fetch them concurrently
+    crypto: Dict[str, Tuple[float, float]] = {}
+    crypto_etag = ""
+    crypto_not_modified = False
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        bonbast_future = ex.submit(scrape_bonbast, bonbast_wanted_names(payload))
+        crypto_future = ex.submit(
+            fetch_crypto_csv, CRYPTO_CSV_URL, prev_crypto_etag, crypto_idx
+        )
+
+        bonbast = bonbast_future.result() or {}
+        try:
+            crypto, crypto_etag, crypto_not_modified = crypto_future.result()
+        except Exception as e:
+            log.warning("[crypto] fetch failed: %s", e)
 
-    bonbast = scrape_bonbast()
     if bonbast:
         update_from_bonbast(payload, bonbast)
     else:
-        print("[bonbast] no data collected; will keep previous prices")
-
-    crypto: Dict[str, Dict[str, Any]] = {}
-    try:
-        crypto = fetch_crypto_csv(CRYPTO_CSV_URL)
-    except Exception as e:
-        print(f"[crypto] fetch failed: {e}")
+        log.info("[bonbast] no data collected; will keep previous prices")
 
     if crypto:
         update_from_crypto_csv(payload, crypto)
+    elif crypto_not_modified:
+        log.info("[crypto] unchanged upstream; keeping previous crypto prices")
     else:
-        print("[crypto] no data collected; will keep previous crypto prices")
+        log.info("[crypto] no data collected; will keep previous crypto prices")
 
     # recompute usdPrice relations & local crypto prices
     recompute_usd_relations(payload)
@@ -641,11 +962,11 @@ def main() -> int:
     new_alias_index = compute_alias_index(payload.rates)
 
     after_fp = numeric_fingerprint(payload.rates)
-    after_idx_blob = json.dumps([new_lists, new_alias_index], ensure_ascii=False, separators=(",", ":"))
-    after_fp = after_fp + "|" + hashlib.sha1(after_idx_blob.encode("utf-8")).hexdigest()
+    after_idx_blob = orjson.dumps([new_lists, new_alias_index])
+    after_fp = after_fp + "|" + hashlib.sha1(after_idx_blob).hexdigest()
 
     if after_fp == before_fp:
-        print("ℹ️ no changes detected; skipping write/commit")
+        log.info("ℹ️ no changes detected; skipping write/commit")
         return 0
 
     # update fetchedAtMs + source (only when we actually write)
@@ -654,7 +975,7 @@ def main() -> int:
 
     ok, msg = validate_payload(payload)
     if not ok:
-        print(f"[validate] FAILED: {msg}")
+        log.error("[validate] FAILED: %s", msg)
         return 3
 
     out_obj: Dict[str, Any] = {
@@ -664,21 +985,32 @@ def main() -> int:
         "lists": new_lists,
         "aliasIndex": new_alias_index,
     }
+    # the ETag (and the crypto name index it was fetched for) must describe the crypto
+    # prices being written: this response's if they were refreshed from it, otherwise
+    # the template's, which the kept prices came from
+    if crypto:
+        out_crypto_etag, out_crypto_idx_hash = crypto_etag, crypto_idx_hash
+    else:
+        out_crypto_etag = str(original.get("cryptoEtag") or "")
+        out_crypto_idx_hash = str(original.get("cryptoIndexHash") or "")
+    if out_crypto_etag:
+        out_obj["cryptoEtag"] = out_crypto_etag
+        out_obj["cryptoIndexHash"] = out_crypto_idx_hash
 
     # Preserve any extra top-level keys in the template (schemaVersion, notes, etc.)
+    # cryptoEtag/cryptoIndexHash are never copied back: empty means "no ETag" for these prices
     if isinstance(original, dict):
         for k, v in original.items():
-            if k not in out_obj:
+            if k not in out_obj and k not in ("cryptoEtag", "cryptoIndexHash"):
                 out_obj[k] = v
 
     # Ensure our computed indexes override template values
     out_obj["lists"] = new_lists
     out_obj["aliasIndex"] = new_alias_index
 
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(out_obj, f, ensure_ascii=False, separators=(",", ":"))
+    write_atomic(OUTPUT_FILE, orjson.dumps(out_obj, option=orjson.OPT_APPEND_NEWLINE))
 
-    print(f"✅ wrote {OUTPUT_FILE} (rates={len(payload.rates)})")
+    log.info("✅ wrote %s (rates=%d)", OUTPUT_FILE, len(payload.rates))
     return 0
 
 